@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
+import ctypes
+import functools
 import hashlib
+import itertools
 import json
 import logging
+import mmap
 import os
 import re
 import shutil
 import sys
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
@@ -16,107 +23,321 @@ import coloredlogs
 from alive_progress import alive_bar
 from sqlcipher3 import dbapi2 as sqlite
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# orjson decodes the (many and large) message JSON blobs considerably faster, if installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 logger = logging.getLogger(__name__)
 
+# ioctl request to reflink a whole file on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+NON_PHONE_NUMBER_CHARS = re.compile(r'[^+\d]')
+
+# SHA-256 digests of attachment files by relative path, with the size and mtime they were computed for -
+# persisted in the output directory to skip rehashing on subsequent runs
+SHA256_CACHE_FILE = '.sha256_cache.json'
+
+# minimum file size to hash via mmap instead of reading it in chunks
+MMAP_HASH_SIZE = 10 * 2 ** 20
+
+# the database is only read: keep more decrypted pages cached
+READ_PRAGMAS = {
+    'query_only': 1,
+    'cache_size': -65536,
+    'temp_store': 'MEMORY',
+}
+
+# content types of the attachments to export
+MEDIA_CONTENT_TYPES = ('image/', 'video/', 'audio/')
+
+# number of messages whose attachments are hashed and copied together
+BATCH_SIZE = 100
+
+Attachment = namedtuple('Attachment', ['sender', 'name', 'src', 'dst', 'src_size', 'dst_exists', 'sent_at'])
+
+# command line args and the config file settings they override
+CONFIG_ARGS = {
+    'config': 'config',
+    'output_dir': 'outputDir',
+    'signal_dir': 'signalDir',
+    'include_expiring_messages': 'includeExpiringMessages',
+    'include_attachments': 'includeAttachments',
+    'verbose': 'verbose',
+    'max_messages': 'maxMessages',
+}
+
 
 def get_key(config):
     with open(os.path.join(config['signalDir'], 'config.json'), 'r') as f:
-        signal_config = json.load(f)
+        signal_config = json_loads(f.read())
 
     key = signal_config['key']
     logger.info('Read sqlcipher key: 0x%s...', key[:8])
     return key
 
 
-def get_messages(config, key):
-    logger.info('Connecting to sql/db.sqlite, reading messages...')
+@contextmanager
+def open_database(config, key):
+    logger.info('Connecting to sql/db.sqlite...')
     conn = sqlite.connect(os.path.join(config['signalDir'], 'sql/db.sqlite'))
     try:
         c = conn.cursor()
         c.execute(f"PRAGMA key=\"x'{key}'\"")
         for setting, value in config.get('sqlcipher', {}).items():
             c.execute(f"PRAGMA {setting}={value}")
+        # (only after the sqlcipher settings, as some pragmas already read the database)
+        for setting, value in READ_PRAGMAS.items():
+            c.execute(f"PRAGMA {setting}={value}")
 
         c.execute("select json from items where id=?", ('number_id',))
-        number_id = json.loads(c.fetchone()[0])
+        number_id = json_loads(c.fetchone()[0])
         own_number, device_id = number_id['value'].split('.')
         logger.info('Own number: %s, device ID: %s', own_number, device_id)
 
-        cond = []
-        cond.append("m.type in ('incoming', 'outgoing')")
-
-        include = config.get('includeAttachments', "visual")
-        if include == "visual":
-            cond.append("m.hasVisualMediaAttachments > 0")
-        elif include == "file":
-            cond.append("m.hasFileAttachments > 0")
-        elif include == "all":
-            cond.append("m.hasAttachments > 0")
-        else:
-            raise ValueError(f"Invalid value '{include}' for 'includeAttachments' in config ")
-
-        if not config.get('includeExpiringMessages', False):
-            cond.append("m.expires_at is null")
-
-        c.execute(f"""
-            select m.id, m.json, sender.e164, coalesce(sender.name, sender.profileFullName)
-            from messages m
-            join conversations conv on m.conversationId == conv.id
-            join conversations sender on m.sourceServiceId == sender.serviceId
-            where {' and '.join(cond)}
-            order by m.sent_at
-            {f'limit {config["maxMessages"]}' if config["maxMessages"] > 0 else ''}
-        """)
-
-        for row in c:
-            msg_id = row[0]
-            msg = json.loads(row[1])
-            sender_e164 = row[2]
-            sender_name = row[3]
-            yield msg_id, msg, sender_e164, sender_name
+        yield c
 
     except sqlite.DatabaseError as err:
         logger.fatal(
             'DatabaseError "%s" - please check the database and the sqlcipher parameters!',
             ' | '.join(err.args)
         )
+        sys.exit(-1)
 
     finally:
         conn.close()
 
 
-def hash_file_quick(path):
-    with open(path, 'br') as f:
-        data = f.read(2 ** 10)
-        return hash(data)
-
+def get_messages_query(config):
+    """
+    Build the from/where part of the media messages query.
+    """
+    cond = []
+    cond.append("m.type in ('incoming', 'outgoing')")
+
+    include = config.get('includeAttachments', "visual")
+    if include == "visual":
+        cond.append("m.hasVisualMediaAttachments > 0")
+    elif include == "file":
+        cond.append("m.hasFileAttachments > 0")
+    elif include == "all":
+        cond.append("m.hasAttachments > 0")
+    else:
+        raise ValueError(f"Invalid value '{include}' for 'includeAttachments' in config ")
+
+    if not config.get('includeExpiringMessages', False):
+        cond.append("m.expires_at is null")
+
+    # only messages with any media attachments, so that the others needn't be decoded at all
+    # (which also makes maxMessages count these only; note the count query for the progress total
+    # runs this filter too, doubling its work compared to the single pass over the candidate rows before)
+    is_media = ' or '.join(f"json_extract(a.value, '$.contentType') like '{t}%'" for t in MEDIA_CONTENT_TYPES)
+    cond.append(f"exists (select 1 from json_each(m.json, '$.attachments') a where {is_media})")
+
+    return f"""
+        from messages m
+        join conversations conv on m.conversationId == conv.id
+        join conversations sender on m.sourceServiceId == sender.serviceId
+        where {' and '.join(cond)}
+    """
 
-def hash_file_sha256(path):
-    sha256 = hashlib.sha256()
-    with open(path, 'br') as f:
-        while True:
-            data = f.read(2 ** 12)
-            if not data:
-                break
-            sha256.update(data)
 
-        return sha256.hexdigest()
+def count_messages(c, config):
+    # with maxMessages, stop counting once reached instead of scanning all messages a second time
+    if config['maxMessages'] > 0:
+        c.execute(f"select count(*) from (select 1 {get_messages_query(config)} limit ?)", (config['maxMessages'],))
+    else:
+        c.execute(f"select count(*) {get_messages_query(config)}")
+    return c.fetchone()[0]
+
+
+def get_messages(c, config):
+    logger.info('Reading messages...')
+    c.arraysize = 1000
+    limit, params = ('limit ?', (config['maxMessages'],)) if config['maxMessages'] > 0 else ('', ())
+    c.execute(f"""
+        select
+            m.id,
+            json_extract(m.json, '$.sent_at'),
+            json_extract(m.json, '$.attachments'),
+            sender.e164,
+            coalesce(sender.name, sender.profileFullName)
+        {get_messages_query(config)}
+        order by m.sent_at
+        {limit}
+    """, params)
+
+    # stream the rows in batches instead of holding all messages in memory,
+    # and only decode the fields needed instead of the whole (potentially large) message JSON
+    while True:
+        rows = c.fetchmany()
+        if not rows:
+            break
+
+        for msg_id, sent_at, attachments, sender_e164, sender_name in rows:
+            msg = {'sent_at': sent_at, 'attachments': json_loads(attachments)}
+            yield msg_id, msg, sender_e164, sender_name
 
 
-def save_attachments(config, hashes, msg_id, msg, sender_e164, sender_name):
-    stats = {
-        'attachments': 0,
-        'attachments_size': 0,
-        'saved_attachments': 0,
-        'saved_attachments_size': 0,
+def load_sha256_cache(config):
+    """
+    Load the SHA-256 cache of previous runs,
+    its entries keyed by the (POSIX) path relative to the attachments directory.
+    """
+    sha256_cache = {'root': os.path.join(config['signalDir'], 'attachments.noindex'), 'entries': {}}
+    try:
+        with open(os.path.join(config['outputDir'], SHA256_CACHE_FILE), 'br') as f:
+            entries = json_loads(f.read())
+    except FileNotFoundError:
+        return sha256_cache
+    except ValueError:
+        entries = None
+
+    if not isinstance(entries, dict):
+        logger.warning('Ignoring invalid SHA-256 cache %s', SHA256_CACHE_FILE)
+        return sha256_cache
+
+    # (absolute paths are left over from older versions of the cache)
+    sha256_cache['entries'] = {
+        key: e for key, e in entries.items()
+        if isinstance(e, list) and len(e) == 3 and not os.path.isabs(key)
     }
+    return sha256_cache
 
-    try:
-        sent = datetime.fromtimestamp(msg['sent_at'] / 1000)
-    except KeyError:
-        logger.warning('Skipping %s (missing sent_at field)', msg_id)
+
+def save_sha256_cache(config, sha256_cache):
+    """
+    Save the SHA-256 cache, dropping the entries of attachment files that no longer exist
+    (those of changed files are just recomputed on their next use).
+
+    >>> import tempfile
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> config = {'signalDir': tmp.name, 'outputDir': os.path.join(tmp.name, 'media')}
+    >>> os.makedirs(os.path.join(tmp.name, 'attachments.noindex', 'ab'))
+    >>> a, b = (os.path.join(tmp.name, 'attachments.noindex', 'ab', name) for name in 'ab')
+    >>> for path in a, b:
+    ...     with open(path, 'w') as f:
+    ...         _ = f.write(os.path.basename(path))
+    >>> sha256_cache = load_sha256_cache(config)
+    >>> hash_file_sha256(sha256_cache, a)[:16], hash_file_sha256(sha256_cache, b)[:16]
+    ('ca978112ca1bbdca', '3e23e8160039594a')
+    >>> save_sha256_cache(config, sha256_cache)
+
+    Unchanged files are looked up by their relative path, regardless of how signalDir is given:
+
+    >>> sha256_cache = load_sha256_cache(dict(config, signalDir=tmp.name + os.sep))
+    >>> sorted(sha256_cache['entries'])
+    ['ab/a', 'ab/b']
+    >>> sha256_cache['entries']['ab/a'][2] = 'cached'
+    >>> hash_file_sha256(sha256_cache, os.path.join(tmp.name + os.sep, 'attachments.noindex', 'ab', 'a'))
+    'cached'
+
+    Entries that weren't needed are kept, unless their file is gone:
+
+    >>> os.remove(a)
+    >>> save_sha256_cache(config, sha256_cache)
+    >>> sorted(load_sha256_cache(config)['entries'])
+    ['ab/b']
+    >>> tmp.cleanup()
+    """
+    if not sha256_cache['entries']:
         return
 
+    entries = {
+        key: e for key, e in sha256_cache['entries'].items()
+        if os.path.exists(os.path.join(sha256_cache['root'], key))
+    }
+    path = os.path.join(config['outputDir'], SHA256_CACHE_FILE)
+    os.makedirs(config['outputDir'], exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(entries, f)
+    os.replace(path + '.tmp', path)
+
+
+def hash_file_sha256(sha256_cache, path):
+    st = os.stat(path)
+    key = os.path.relpath(path, sha256_cache['root']).replace(os.sep, '/')
+    entry = [st.st_size, st.st_mtime_ns]
+    cached = sha256_cache['entries'].get(key)
+    if cached is not None and cached[:2] == entry:
+        return cached[2]
+
+    with open(path, 'br') as f:
+        # large files (videos) are hashed in one go straight from the page cache
+        if st.st_size >= MMAP_HASH_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sha256 = hashlib.sha256(mm)
+
+        # Python 3.11+ runs the read/update loop in C
+        elif hasattr(hashlib, 'file_digest'):
+            sha256 = hashlib.file_digest(f, 'sha256')
+        else:
+            sha256 = hashlib.sha256()
+            buf = bytearray(2 ** 20)
+            view = memoryview(buf)
+            while True:
+                size = f.readinto(buf)
+                if not size:
+                    break
+                sha256.update(view[:size])
+
+    digest = sha256.hexdigest()
+    sha256_cache['entries'][key] = entry + [digest]
+    return digest
+
+
+def bucket_sha256_digests(sha256_cache, bucket):
+    """
+    Yield the SHA-256 digests of a file size bucket of (path, sha256) entries,
+    computing and storing missing digests on first use.
+    """
+    for i, (path, sha256) in enumerate(bucket):
+        if sha256 is None:
+            sha256 = hash_file_sha256(sha256_cache, path)
+            bucket[i] = (path, sha256)
+        yield sha256
+
+
+def prefetch_sha256_digests(executor, sha256_cache, hashes, sources):
+    """
+    Concurrently compute the SHA-256 digests needed to deduplicate a batch of (size, path, exists) sources.
+    Only sizes of new sources matter, for which those colliding with a bucket or with each other are hashed,
+    along with the missing digests of these buckets.
+    """
+    sources = list(sources)
+    counts = Counter(size for size, _, _ in sources)
+    new_sizes = {size for size, _, exists in sources if not exists}
+    paths = {path for size, path, _ in sources if size in new_sizes and (size in hashes or counts[size] > 1)}
+    paths.update(path for size in new_sizes for path, sha256 in hashes.get(size, []) if sha256 is None)
+
+    digests = dict(zip(paths, executor.map(functools.partial(hash_file_sha256, sha256_cache), paths)))
+    for size in new_sizes:
+        bucket = hashes.get(size, [])
+        for i, (path, sha256) in enumerate(bucket):
+            if sha256 is None:
+                bucket[i] = (path, digests[path])
+
+    return digests
+
+
+def get_attachments(config, stats, msg_id, msg, sender_e164, sender_name):
+    """
+    Resolve the media attachments of a message to be exported, counting them in stats.
+    Returns them along with the warnings for skipped ones, to be logged once the message is saved.
+    """
+    skipped = []
+    if msg['sent_at'] is None:
+        skipped.append(('Skipping %s (missing sent_at field)', msg_id))
+        return [], skipped
+    sent_at = msg['sent_at'] / 1000
+
     sender = None
     sender_keys = [s for s in (sender_e164, sender_name) if s is not None]
 
@@ -125,69 +346,180 @@ def save_attachments(config, hashes, msg_id, msg, sender_e164, sender_name):
         try:
             sender = next(config['map'][k] for k in sender_keys if k in config['map'])
         except StopIteration:
-            logger.warning('Skipping %s (sender number/name not mapped: %s)', msg_id, ", ".join(sender_keys))
-            return
+            skipped.append(('Skipping %s (sender number/name not mapped: %s)', msg_id, ", ".join(sender_keys)))
+            return [], skipped
 
     # or without map, use number only (sender_name might not be valid and safe dir name)
     elif sender_e164 is not None:
         sender = sender_e164
     else:
-        logger.warning('Skipping %s (sender number unknown)', msg_id)
-        return
+        skipped.append(('Skipping %s (sender number unknown)', msg_id))
+        return [], skipped
+
+    attachments_dir = os.path.join(config['signalDir'], 'attachments.noindex')
+    sender_dir = os.path.join(config['outputDir'], sender)
+    numbered = len(msg['attachments']) > 1
+    timestamp = format_timestamp(msg['sent_at'] // 1000)
 
+    attachments = []
     for idx, at in enumerate(msg['attachments']):
-        if not at['contentType'].lower().startswith(('image/', 'video/', 'audio/')):
+        if not at['contentType'].lower().startswith(MEDIA_CONTENT_TYPES):
             continue
 
         ext = get_file_extension(at)
 
-        name = ['signal', sent.strftime('%Y-%m-%d-%H%M%S')]
-        if len(msg['attachments']) > 1:
+        name = ['signal', timestamp]
+        if numbered:
             name += str(idx)
         name = '{}.{}'.format('-'.join(name), ext)
 
         if at.get('pending', False) or not at.get('path'):
-            logger.warning('Skipping %s/%s (media file not downloaded)', sender, name)
+            skipped.append(('Skipping %s/%s (media file not downloaded)', sender, name))
             continue
         # if accessing a Windows signal database, need to fix paths
         if '\\' in at['path']:
             at_path = os.path.join(*at['path'].split('\\'))
         else:
             at_path = at['path']
-        src = os.path.join(config['signalDir'], 'attachments.noindex', at_path)
-        dst = os.path.join(config['outputDir'], sender, name)
-        if not os.path.exists(src):
-            logger.warning('Skipping %s/%s (media file not found)', sender, name)
+        src = os.path.join(attachments_dir, at_path)
+        dst = os.path.join(sender_dir, name)
+        try:
+            src_size = os.stat(src).st_size
+        except FileNotFoundError:
+            skipped.append(('Skipping %s/%s (media file not found)', sender, name))
             continue
 
-        stats['attachments'] = stats['attachments'] + 1
-        stats['attachments_size'] = stats['attachments_size'] + os.path.getsize(src)
+        stats['attachments'] += 1
+        stats['attachments_size'] += src_size
+        attachments.append(Attachment(sender, name, src, dst, src_size, os.path.exists(dst), sent_at))
+
+    return attachments, skipped
 
-        quick_hash = hash_file_quick(src)
-        if quick_hash in hashes:
-            if hash_file_sha256(src) in (hash_file_sha256(f) for f in hashes[quick_hash]):
-                logger.info('Skipping %s/%s (already saved an identical file)', sender, name)
-                continue
 
-        if os.path.exists(dst):
-            logger.debug('Skipping %s/%s (file exists)', sender, name)
-            hashes.setdefault(quick_hash, []).append(src)
+def save_attachments(stats, sha256_cache, hashes, created_dirs, executor, messages):
+    """
+    Deduplicate and copy the attachments of a batch of messages, given as (attachments, skipped) in message order.
+    Yields after each message is done, logging its skipped and saved attachments in order.
+    """
+    attachments = [at for msg_attachments, _ in messages for at in msg_attachments]
+
+    # files are bucketed by size (identical files can't differ in size), only colliding ones get hashed -
+    # concurrently for the whole batch, while the deduplication itself stays sequential
+    sources = ((at.src_size, at.src, at.dst_exists) for at in attachments)
+    digests = prefetch_sha256_digests(executor, sha256_cache, hashes, sources)
+
+    copies = []
+    copied_dsts = set()
+    decisions = []
+    for at in attachments:
+        src_sha256 = digests.get(at.src)
+
+        # existing files are skipped anyway, without hashing them (an earlier message of the batch
+        # with the same sender and second may also be about to save the same file name)
+        if at.dst_exists or at.dst in copied_dsts:
+            decisions.append('exists')
+            hashes.setdefault(at.src_size, []).append((at.src, src_sha256))
             continue
 
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        shutil.copyfile(src, dst)
+        if at.src_size in hashes:
+            if src_sha256 in bucket_sha256_digests(sha256_cache, hashes[at.src_size]):
+                decisions.append('identical')
+                continue
+
+        decisions.append('copy')
+        copies.append(at)
+        copied_dsts.add(at.dst)
+        hashes.setdefault(at.src_size, []).append((at.src, src_sha256))
+
+    for sender_dir in {os.path.dirname(at.dst) for at in copies} - created_dirs:
+        os.makedirs(sender_dir, exist_ok=True)
+        created_dirs.add(sender_dir)
+
+    # the copies don't depend on each other, so they run concurrently as well -
+    # but each message is only reported once its own copies are done
+    results = executor.map(save_file, copies)
+    outcomes = zip(attachments, decisions)
+    for msg_attachments, skipped in messages:
+        for warning in skipped:
+            logger.warning(*warning)
+
+        for at, decision in itertools.islice(outcomes, len(msg_attachments)):
+            if decision == 'exists':
+                logger.debug('Skipping %s/%s (file exists)', at.sender, at.name)
+            elif decision == 'identical':
+                logger.info('Skipping %s/%s (already saved an identical file)', at.sender, at.name)
+            else:
+                next(results)
+                logger.info('Saved %s [%.1f KiB]', at.dst, at.src_size / 1024)
+
+                stats['saved_attachments'] += 1
+                stats['saved_attachments_size'] += at.src_size
+
+        yield
+
+
+def format_timestamp(timestamp):
+    """
+    Format a POSIX timestamp (in seconds) for use in file names.
+    """
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d-%H%M%S')
+
+
+def copy_file(src, dst):
+    """
+    Copy src to dst as a copy-on-write clone if the file system supports it, or else as an in-kernel or regular copy.
+    """
+    if fcntl is not None and sys.platform.startswith('linux'):
         try:
-            os.utime(dst, times=(sent.timestamp(), sent.timestamp()))
-        except PermissionError:
+            with open(src, 'br') as fsrc, open(dst, 'bw') as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    return
+                except OSError:
+                    pass
+
+                # or at least copy within the kernel (server-side on NFS 4.2 and SMB)
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+                if remaining <= 0:
+                    return
+        except (OSError, AttributeError):
             pass
-        size = os.path.getsize(dst)
-        logger.info('Saved %s [%.1f KiB]', dst, size / 1024)
 
-        stats['saved_attachments'] = stats['saved_attachments'] + 1
-        stats['saved_attachments_size'] = stats['saved_attachments_size'] + size
-        hashes.setdefault(quick_hash, []).append(src)
+    elif sys.platform == 'darwin':
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0:
+                return
+        except (OSError, AttributeError):
+            pass
 
-    return stats
+    shutil.copyfile(src, dst)
+
+
+def save_file(at):
+    copy_file(at.src, at.dst)
+    try:
+        os.utime(at.dst, times=(at.sent_at, at.sent_at))
+    except PermissionError:
+        pass
+
+
+def batched(iterable, n):
+    """
+    >>> list(batched('abcde', 2))
+    [['a', 'b'], ['c', 'd'], ['e']]
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
 
 
 def get_file_extension(at):
@@ -196,11 +528,20 @@ def get_file_extension(at):
     'jpeg'
     >>> get_file_extension({'contentType': 'audio/ogg; codecs=opus'})
     'ogg'
+    >>> get_file_extension({'contentType': 'Image/PNG'})
+    'png'
+    >>> get_file_extension({'contentType': 'image/jpeg/../../escaped'})
+    'jpeg'
     """
-    ext = at['contentType'].lower().split('/')[1]
-    if ';' in ext:
-        ext = ext.split(';')[0]
-    return ext
+    return get_content_type_extension(at['contentType'])
+
+
+@functools.lru_cache(maxsize=64)
+def get_content_type_extension(content_type):
+    # there are only a handful of distinct content types, repeated for thousands of attachments
+    # (the subtype ends at any further path separator, as the sender-supplied content type mustn't inject paths)
+    ext = content_type.partition('/')[2].partition(';')[0].partition('/')[0].partition('\\')[0]
+    return ext.lower()
 
 
 def sanitize_sender_key(key: str) -> str:
@@ -217,7 +558,7 @@ def sanitize_phone_number(no: str) -> str:
     """
     Sanitize phone numbers by removing non-digits.
     """
-    return re.sub(r'[^+\d]', '', no)
+    return NON_PHONE_NUMBER_CHARS.sub('', no)
 
 
 def main():
@@ -273,14 +614,14 @@ def main():
         metavar='N',
         nargs='?',
         type=int,
-        help=f"Export media for at most N messages then stop (default: 0 = no limit)"
+        help=f"Export media for at most N messages with media attachments then stop (default: 0 = no limit)"
     )
     args = parser.parse_args()
 
     # command line args override the settings from the config file, which override the default settings
     try:
         with open(args.config if args.config else config['config'], 'r') as f:
-            config = {**config, **json.load(f)}
+            config.update(json_loads(f.read()))
     except FileNotFoundError:
         if args.config:
             raise
@@ -289,8 +630,7 @@ def main():
         if value is None:
             continue
 
-        arg_camelcase = ''.join(w.lower() if i == 0 else w.title() for i, w in enumerate(arg.split('_')))
-        config[arg_camelcase] = value
+        config[CONFIG_ARGS[arg]] = value
 
     # configure logging verbosity
     verbose = config.get('verbose', False)
@@ -306,12 +646,11 @@ def main():
 
     # validate maxMessages
     if config['maxMessages'] < 0:
-        logger.error(f'Invalid max number of messages {config["maxMessages"]} (must be >= 0).')
+        logger.error('Invalid max number of messages %d (must be >= 0).', config['maxMessages'])
         sys.exit(-1)
 
     # read the encrypted DB and run the export
     key = get_key(config)
-    msgs = list(get_messages(config, key))
     stats = {
         'attachments': 0,
         'attachments_size': 0,
@@ -319,14 +658,18 @@ def main():
         'saved_attachments_size': 0,
     }
     hashes = {}
+    created_dirs = set()
+    sha256_cache = load_sha256_cache(config)
 
-    with progress(verbose, stats, len(msgs)) as report:
-        for msg in msgs:
-            msg_stats = save_attachments(config, hashes, *msg)
-            for key, value in msg_stats.items() if msg_stats else {}:
-                stats[key] = stats.setdefault(key, 0) + value
+    with open_database(config, key) as c:
+        total = count_messages(c, config)
+        with progress(verbose, stats, total) as report, ThreadPoolExecutor(os.cpu_count()) as executor:
+            for msgs in batched(get_messages(c, config), BATCH_SIZE):
+                messages = [get_attachments(config, stats, *msg) for msg in msgs]
+                for _ in save_attachments(stats, sha256_cache, hashes, created_dirs, executor, messages):
+                    report()
 
-            report()
+    save_sha256_cache(config, sha256_cache)
 
     if not stats:
         logger.error('No media messages found.')
@@ -337,18 +680,25 @@ def main():
 def progress(verbose, stats, total):
     i = 0
     stats_frequency = 50
+    percent_per_msg = 100 / total if total else 0
 
     def msg_stats():
-        return f'{i:04d}/{total:04d} messages | {i * 100 / total:.1f} % processed'
+        return f'{i:04d}/{total:04d} messages | {i * percent_per_msg:.1f} % processed'
 
     def size_stats():
         return f'{stats["saved_attachments_size"] / 2 ** 20:.1f}/{stats["attachments_size"] / 2 ** 20:.1f} MiB'
 
     if verbose:
+        # log progress at most once per interval, regardless of how fast messages are processed
+        log_interval = 1.0
+        last_log = time.monotonic()
+
         def report():
-            nonlocal i
+            nonlocal i, last_log
             i += 1
-            if not i % stats_frequency:
+            now = time.monotonic()
+            if now - last_log >= log_interval:
+                last_log = now
                 logger.info('%s [%s]', msg_stats(), size_stats())
 
         yield report